@@ -4,6 +4,8 @@
 DRIVE_ROOT = "/content/drive/MyDrive/Project_Credit Supply and Market Share Reallocation/zhixi"
 MASTER_DIR = f"{DRIVE_ROOT}/master_with_sic_links"   # cleaned firm-year parquets
 OUTPUT_DIR = f"{DRIVE_ROOT}/new_outcomes"              # where CSVs land
+PANEL_VERSION = 1                                       # bump when load-time derivations change
+PANEL_DIR = f"{OUTPUT_DIR}/panel_v{PANEL_VERSION}"      # cached firm-year panel (country/year partitions)
 
 # Time structure
 YEARS = range(2009, 2016)        # 2009–2015
@@ -0,0 +1,112 @@
+"""
+Shared building blocks for the outcome modules.
+
+  s_it = sales_it / Σ_{i ∈ j} sales_it   within industry j (country × SIC2), year t
+
+All per-industry moments (sums, Σx², counts) are plain Polars aggregates.
+Keep them that way: a map_batches/Python UDF in a group_by runs once per
+group under the GIL and drops the plan out of the streaming engine.
+"""
+
+import polars as pl
+from config import (
+    YEAR_COL, COUNTRY_COL, INDUSTRY_COL, SALES_COL,
+)
+
+
+def positive(*cols: str) -> pl.Expr:
+    """True where every one of several columns is non-null and > 0."""
+    return pl.all_horizontal(pl.col(list(cols)) > 0)
+
+
+def with_shares(df: pl.LazyFrame) -> pl.LazyFrame:
+    """Keep firm-years with positive sales and add within-industry sales share.
+
+    Industry-year sales totals are collected first (one small streaming
+    pass) and joined back as an in-memory table, so the join streams the
+    panel instead of buffering it. Null keys match each other, so they
+    form their own group as in a window. load_data applies this to the
+    whole panel; modules that work on a sub-sample call it again to
+    renormalise shares over that sample.
+    """
+    keys = [COUNTRY_COL, INDUSTRY_COL, YEAR_COL]
+    pos = df.filter(pl.col(SALES_COL) > 0)
+    totals = (
+        pos
+        .group_by(keys, maintain_order=False)
+        .agg(pl.col(SALES_COL).sum().alias("_ind_sales"))
+        .collect(engine="streaming")
+    )
+    return (
+        pos
+        .join(totals.lazy(), on=keys, how="left", nulls_equal=True)
+        .with_columns((pl.col(SALES_COL) / pl.col("_ind_sales")).alias("share"))
+        .drop("_ind_sales")
+    )
+
+
+def pivot_horizons(
+    long: pl.LazyFrame,
+    labels: dict,
+    base_year: int,
+    horizons: list,
+) -> pl.LazyFrame:
+    """Spread a long [country, industry, horizon, value...] frame to wide.
+
+    labels maps each value column to its output stem, giving columns
+    LD_{label}_{base_year}_{h}. Industries must be observed at the first
+    horizon; later horizons may be null.
+    """
+    horizon = pl.col("horizon")
+    return (
+        long
+        .group_by([COUNTRY_COL, INDUSTRY_COL], maintain_order=False)
+        .agg(
+            [(horizon == horizons[0]).any().alias("_in_first")]
+            + [
+                pl.col(col).filter(horizon == h).first().alias(f"LD_{label}_{base_year}_{h}")
+                for h in horizons
+                for col, label in labels.items()
+            ]
+        )
+        .filter(pl.col("_in_first"))
+        .drop("_in_first")
+    )
+
+
+def long_difference(
+    by_year: pl.LazyFrame,
+    labels: dict,
+    base_year: int,
+    horizons: list,
+) -> pl.LazyFrame:
+    """Long-difference industry-year values from base_year to each horizon.
+
+    The base-year slice is small (one row per industry), so it is broadcast
+    onto all horizon years with a single join instead of one join per horizon.
+    """
+    keys = [COUNTRY_COL, INDUSTRY_COL]
+    base = by_year.filter(pl.col(YEAR_COL) == base_year).select(
+        keys + [pl.col(col).alias(f"{col}_base") for col in labels]
+    )
+
+    long = (
+        by_year
+        .filter(pl.col(YEAR_COL).is_in(horizons))
+        .join(base, on=keys, how="inner")
+        .select(
+            keys
+            + [pl.col(YEAR_COL).alias("horizon")]
+            + [(pl.col(col) - pl.col(f"{col}_base")).alias(col) for col in labels]
+        )
+    )
+    return pivot_horizons(long, labels, base_year, horizons)
+
+
+def to_output(out: pl.LazyFrame) -> pl.LazyFrame:
+    """Rename industry keys to the IV pipeline convention (plain strings)."""
+    return out.select(
+        pl.col(COUNTRY_COL).cast(pl.Utf8).alias("fic_code"),
+        pl.col(INDUSTRY_COL).cast(pl.Utf8).alias("borrower_sic"),
+        pl.exclude(COUNTRY_COL, INDUSTRY_COL),
+    )
@@ -11,145 +11,114 @@ Long-differences relative to 2012.
 import polars as pl
 from config import (
     FIRM_COL, YEAR_COL, COUNTRY_COL, INDUSTRY_COL,
-    SALES_COL, TREATMENT_YEAR, HORIZONS,
+    TREATMENT_YEAR, HORIZONS,
     PRESHOCK_BASE, BLOCK2_HORIZONS,
 )
+from outcomes.common import long_difference, to_output
 
 
-def _compute_concentration_by_year(df: pl.LazyFrame) -> pl.LazyFrame:
-    """Compute CR4, n_firms per industry-year."""
-    base = (
-        df
-        .filter(pl.col(SALES_COL).is_not_null() & (pl.col(SALES_COL) > 0))
-        .with_columns(
-            (pl.col(SALES_COL) / pl.col(SALES_COL).sum().over([COUNTRY_COL, INDUSTRY_COL, YEAR_COL]))
-            .alias("share")
-        )
-    )
+def _compute_cr4_by_year(df: pl.LazyFrame) -> pl.DataFrame:
+    """Compute CR4 per industry-year from per-batch partial top-4 lists.
 
-    # CR4: rank shares within industry-year, sum top 4
-    cr4 = (
-        base
-        .with_columns(
-            pl.col("share")
-            .rank(method="ordinal", descending=True)
-            .over([COUNTRY_COL, INDUSTRY_COL, YEAR_COL])
-            .alias("rank")
+    top_k is not a streaming aggregate, so the panel is streamed in batches
+    and each batch is merged into the running top-4 shares per industry-year.
+    Only one batch and the top-4 lists are held in memory.
+    """
+    keys = [COUNTRY_COL, INDUSTRY_COL, YEAR_COL]
+    panel = df.select(keys + ["share"])
+    top4 = pl.DataFrame(schema=panel.collect_schema())
+    for batch in panel.collect_batches(
+        chunk_size=1_000_000, maintain_order=False, engine="streaming",
+    ):
+        # top_k rather than rank/sort+head for speed; the batch bounds memory
+        top4 = (
+            pl.concat([top4, batch])
+            .group_by(keys, maintain_order=False)
+            .agg(pl.col("share").top_k(4))
+            .explode("share")
         )
-        .filter(pl.col("rank") <= 4)
-        .group_by([COUNTRY_COL, INDUSTRY_COL, YEAR_COL])
-        .agg(pl.col("share").sum().alias("cr4"))
-    )
-
-    # n_firms
-    n_firms = (
-        base
-        .group_by([COUNTRY_COL, INDUSTRY_COL, YEAR_COL])
-        .agg(pl.col(FIRM_COL).n_unique().cast(pl.Int64).alias("n_firms"))
+    return top4.group_by(keys, maintain_order=False).agg(
+        pl.col("share").sum().alias("cr4")
     )
 
-    return cr4.join(n_firms, on=[COUNTRY_COL, INDUSTRY_COL, YEAR_COL], how="left")
 
-
-def _compute_turbulence(df: pl.LazyFrame) -> pl.DataFrame:
-    """Compute turbulence = sum of |Δshare| between consecutive years."""
-    collected = (
+def _compute_concentration_by_year(df: pl.LazyFrame) -> pl.LazyFrame:
+    """Compute CR4, n_firms per industry-year (df carries share from load_data)."""
+    keys = [COUNTRY_COL, INDUSTRY_COL, YEAR_COL]
+    return (
         df
-        .filter(pl.col(SALES_COL).is_not_null() & (pl.col(SALES_COL) > 0))
-        .with_columns(
-            (pl.col(SALES_COL) / pl.col(SALES_COL).sum().over([COUNTRY_COL, INDUSTRY_COL, YEAR_COL]))
-            .alias("share")
-        )
-        .collect()
+        .group_by(keys, maintain_order=False)
+        # n_firms: the panel is unique on (firm, year), so a row count suffices
+        .agg(pl.len().cast(pl.Int64).alias("n_firms"))
+        .join(_compute_cr4_by_year(df).lazy(), on=keys, how="left", nulls_equal=True)
+        .select(keys + ["cr4", "n_firms"])
     )
 
-    results = []
-    for h in HORIZONS:
-        base = collected.filter(pl.col(YEAR_COL) == TREATMENT_YEAR)
-        horizon = collected.filter(pl.col(YEAR_COL) == h)
 
-        merged = base.join(
+def _compute_turbulence(
+    df: pl.LazyFrame,
+    base_year: int = TREATMENT_YEAR,
+    horizons: list = HORIZONS,
+) -> pl.LazyFrame:
+    """Compute turbulence = sum of |Δshare| between base_year and each horizon.
+
+    One self-join of the base-year cross-section against all horizon years,
+    then one group_by producing a column per horizon. As with the other
+    long-differences, industries need surviving firms at the first horizon;
+    a later horizon without any stays null.
+    """
+    shares = df.select([FIRM_COL, COUNTRY_COL, INDUSTRY_COL, YEAR_COL, "share"])
+    base = shares.filter(pl.col(YEAR_COL) == base_year)
+    horizon = shares.filter(pl.col(YEAR_COL).is_in(horizons))
+
+    year_h = pl.col(f"{YEAR_COL}_h")
+    return (
+        base.join(
             horizon,
             on=[FIRM_COL, COUNTRY_COL, INDUSTRY_COL],
             suffix="_h",
         )
-
-        turb = (
-            merged
-            .with_columns(
-                (pl.col("share_h") - pl.col("share")).abs().alias("abs_d_share")
-            )
-            .group_by([COUNTRY_COL, INDUSTRY_COL])
-            .agg(pl.col("abs_d_share").sum().alias(f"LD_turbulence_2012_{h}"))
+        .with_columns(
+            (pl.col("share_h") - pl.col("share")).abs().alias("abs_d_share")
         )
-        results.append(turb)
-
-    if not results:
-        return pl.DataFrame()
-
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
-    return out
+        .group_by([COUNTRY_COL, INDUSTRY_COL], maintain_order=False)
+        .agg(
+            [(year_h == horizons[0]).any().alias("_in_first")]
+            + [
+                pl.when((year_h == h).any())
+                .then(pl.col("abs_d_share").filter(year_h == h).sum())
+                .alias(f"LD_turbulence_{base_year}_{h}")
+                for h in horizons
+            ]
+        )
+        .filter(pl.col("_in_first"))
+        .drop("_in_first")
+    )
 
 
-def compute_concentration(df: pl.LazyFrame) -> pl.DataFrame:
+def compute_concentration(df: pl.LazyFrame) -> pl.LazyFrame:
     """
     Compute long-difference CR4, n_firms, and turbulence.
 
-    Returns industry-level DataFrame with columns:
+    Returns industry-level LazyFrame with columns:
       fic_code, borrower_sic,
       LD_CR4_2012_2013, ..., LD_n_firms_2012_2013, ...,
       LD_turbulence_2012_2013, ...
     """
-    conc = _compute_concentration_by_year(df).collect()
-
-    base = (
-        conc.filter(pl.col(YEAR_COL) == TREATMENT_YEAR)
-        .select([
-            COUNTRY_COL, INDUSTRY_COL,
-            pl.col("cr4").alias("base_cr4"),
-            pl.col("n_firms").alias("base_n_firms"),
-        ])
+    out = long_difference(
+        _compute_concentration_by_year(df),
+        {"cr4": "CR4", "n_firms": "n_firms"},
+        TREATMENT_YEAR, HORIZONS,
     )
 
-    results = []
-    for h in HORIZONS:
-        horizon = conc.filter(pl.col(YEAR_COL) == h)
-        ld = (
-            base.join(horizon, on=[COUNTRY_COL, INDUSTRY_COL], how="inner")
-            .with_columns([
-                (pl.col("cr4") - pl.col("base_cr4")).alias(f"LD_CR4_2012_{h}"),
-                (pl.col("n_firms") - pl.col("base_n_firms")).alias(f"LD_n_firms_2012_{h}"),
-            ])
-            .select([
-                COUNTRY_COL, INDUSTRY_COL,
-                f"LD_CR4_2012_{h}",
-                f"LD_n_firms_2012_{h}",
-            ])
-        )
-        results.append(ld)
-
-    if not results:
-        return pl.DataFrame()
-
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
-
     # Add turbulence
     turb = _compute_turbulence(df)
-    if turb.height > 0:
-        out = out.join(turb, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
+    out = out.join(turb, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
 
-    out = out.rename({
-        COUNTRY_COL: "fic_code",
-        INDUSTRY_COL: "borrower_sic",
-    })
-    return out
+    return to_output(out)
 
 
-def compute_concentration_block2(df: pl.LazyFrame) -> pl.DataFrame:
+def compute_concentration_block2(df: pl.LazyFrame) -> pl.LazyFrame:
     """
     Compute long-difference CR4, n_firms, and turbulence from PRESHOCK_BASE.
 
@@ -157,90 +126,14 @@ def compute_concentration_block2(df: pl.LazyFrame) -> pl.DataFrame:
       LD_CR4_2010_2013, LD_CR4_2010_2014,
       LD_n_firms_2010_2013, ..., LD_turbulence_2010_2013, ...
     """
-    conc = _compute_concentration_by_year(df).collect()
-
-    base = (
-        conc.filter(pl.col(YEAR_COL) == PRESHOCK_BASE)
-        .select([
-            COUNTRY_COL, INDUSTRY_COL,
-            pl.col("cr4").alias("base_cr4"),
-            pl.col("n_firms").alias("base_n_firms"),
-        ])
+    out = long_difference(
+        _compute_concentration_by_year(df),
+        {"cr4": "CR4", "n_firms": "n_firms"},
+        PRESHOCK_BASE, BLOCK2_HORIZONS,
     )
 
-    results = []
-    for h in BLOCK2_HORIZONS:
-        horizon = conc.filter(pl.col(YEAR_COL) == h)
-        ld = (
-            base.join(horizon, on=[COUNTRY_COL, INDUSTRY_COL], how="inner")
-            .with_columns([
-                (pl.col("cr4") - pl.col("base_cr4")).alias(f"LD_CR4_{PRESHOCK_BASE}_{h}"),
-                (pl.col("n_firms") - pl.col("base_n_firms")).alias(f"LD_n_firms_{PRESHOCK_BASE}_{h}"),
-            ])
-            .select([
-                COUNTRY_COL, INDUSTRY_COL,
-                f"LD_CR4_{PRESHOCK_BASE}_{h}",
-                f"LD_n_firms_{PRESHOCK_BASE}_{h}",
-            ])
-        )
-        results.append(ld)
-
-    if not results:
-        return pl.DataFrame()
-
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
-
     # Turbulence from 2010 base
-    turb = _compute_turbulence_block2(df)
-    if turb.height > 0:
-        out = out.join(turb, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
-
-    out = out.rename({
-        COUNTRY_COL: "fic_code",
-        INDUSTRY_COL: "borrower_sic",
-    })
-    return out
-
-
-def _compute_turbulence_block2(df: pl.LazyFrame) -> pl.DataFrame:
-    """Compute turbulence from PRESHOCK_BASE to each BLOCK2_HORIZON."""
-    collected = (
-        df
-        .filter(pl.col(SALES_COL).is_not_null() & (pl.col(SALES_COL) > 0))
-        .with_columns(
-            (pl.col(SALES_COL) / pl.col(SALES_COL).sum().over([COUNTRY_COL, INDUSTRY_COL, YEAR_COL]))
-            .alias("share")
-        )
-        .collect()
-    )
-
-    results = []
-    for h in BLOCK2_HORIZONS:
-        base = collected.filter(pl.col(YEAR_COL) == PRESHOCK_BASE)
-        horizon = collected.filter(pl.col(YEAR_COL) == h)
-
-        merged = base.join(
-            horizon,
-            on=[FIRM_COL, COUNTRY_COL, INDUSTRY_COL],
-            suffix="_h",
-        )
-
-        turb = (
-            merged
-            .with_columns(
-                (pl.col("share_h") - pl.col("share")).abs().alias("abs_d_share")
-            )
-            .group_by([COUNTRY_COL, INDUSTRY_COL])
-            .agg(pl.col("abs_d_share").sum().alias(f"LD_turbulence_{PRESHOCK_BASE}_{h}"))
-        )
-        results.append(turb)
-
-    if not results:
-        return pl.DataFrame()
+    turb = _compute_turbulence(df, PRESHOCK_BASE, BLOCK2_HORIZONS)
+    out = out.join(turb, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
 
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
-    return out
+    return to_output(out)
@@ -17,98 +17,77 @@ from config import (
     TREATMENT_YEAR, HORIZONS,
     PRESHOCK_BASE, BLOCK2_HORIZONS,
 )
+from outcomes.common import long_difference, to_output
+
+
+_METRICS = ["mrpl", "mrpk", "markup"]
+
+
+def _sample_std(m: str) -> pl.Expr:
+    """Sample std (ddof=1) from n_m, s_m, ss_m; null for fewer than 2 obs."""
+    n, s, ss = pl.col(f"n_{m}"), pl.col(f"s_{m}"), pl.col(f"ss_{m}")
+    var = ((ss - s * s / n) / (n - 1)).clip(lower_bound=0)
+    return pl.when(n > 1).then(var.sqrt())
 
 
 def _compute_dispersion_by_year(df: pl.LazyFrame) -> pl.LazyFrame:
-    """Compute within-industry std of log ratios per industry-year."""
+    """Compute within-industry std of log ratios per industry-year (df has positive sales from load_data)."""
     return (
         df
-        .filter(
-            pl.col(SALES_COL).is_not_null() & (pl.col(SALES_COL) > 0)
-        )
         .with_columns([
-            pl.when(
-                pl.col(EMPLOYEES_COL).is_not_null() & (pl.col(EMPLOYEES_COL) > 0)
-            ).then(
+            pl.when(pl.col(EMPLOYEES_COL) > 0).then(
                 (pl.col(SALES_COL) / pl.col(EMPLOYEES_COL)).log()
             ).alias("log_mrpl"),
 
-            pl.when(
-                pl.col(ASSETS_COL).is_not_null() & (pl.col(ASSETS_COL) > 0)
-            ).then(
+            pl.when(pl.col(ASSETS_COL) > 0).then(
                 (pl.col(SALES_COL) / pl.col(ASSETS_COL)).log()
             ).alias("log_mrpk"),
 
-            pl.when(
-                pl.col(COGS_COL).is_not_null() & (pl.col(COGS_COL) > 0)
-            ).then(
+            pl.when(pl.col(COGS_COL) > 0).then(
                 (pl.col(SALES_COL) / pl.col(COGS_COL)).log()
             ).alias("log_markup"),
         ])
-        .group_by([COUNTRY_COL, INDUSTRY_COL, YEAR_COL])
+        # One pass of mergeable moments (n, Σx, Σx²) instead of .std()
+        .group_by([COUNTRY_COL, INDUSTRY_COL, YEAR_COL], maintain_order=False)
         .agg([
-            pl.col("log_mrpl").std().alias("sigma_mrpl"),
-            pl.col("log_mrpk").std().alias("sigma_mrpk"),
-            pl.col("log_markup").std().alias("sigma_markup"),
+            agg
+            for m in _METRICS
+            for agg in (
+                pl.col(f"log_{m}").count().alias(f"n_{m}"),
+                pl.col(f"log_{m}").sum().alias(f"s_{m}"),
+                pl.col(f"log_{m}").pow(2).sum().alias(f"ss_{m}"),
+            )
         ])
+        .select(
+            [COUNTRY_COL, INDUSTRY_COL, YEAR_COL]
+            + [_sample_std(m).alias(f"sigma_{m}") for m in _METRICS]
+        )
     )
 
 
-def compute_dispersion(df: pl.LazyFrame) -> pl.DataFrame:
+def compute_dispersion(df: pl.LazyFrame) -> pl.LazyFrame:
     """
     Compute long-difference dispersion measures.
 
-    Returns industry-level DataFrame with columns:
+    Returns industry-level LazyFrame with columns:
       fic_code, borrower_sic,
       LD_sigma_MRPL_2012_2013, ..., LD_sigma_MRPK_2012_2013, ...,
       LD_sigma_markup_2012_2013, ...
     """
-    disp = _compute_dispersion_by_year(df).collect()
-
-    base = (
-        disp.filter(pl.col(YEAR_COL) == TREATMENT_YEAR)
-        .select([
-            COUNTRY_COL, INDUSTRY_COL,
-            pl.col("sigma_mrpl").alias("base_mrpl"),
-            pl.col("sigma_mrpk").alias("base_mrpk"),
-            pl.col("sigma_markup").alias("base_markup"),
-        ])
+    out = long_difference(
+        _compute_dispersion_by_year(df),
+        {
+            "sigma_mrpl": "sigma_MRPL",
+            "sigma_mrpk": "sigma_MRPK",
+            "sigma_markup": "sigma_markup",
+        },
+        TREATMENT_YEAR, HORIZONS,
     )
 
-    results = []
-    for h in HORIZONS:
-        horizon = disp.filter(pl.col(YEAR_COL) == h)
-        ld = (
-            base.join(horizon, on=[COUNTRY_COL, INDUSTRY_COL], how="inner")
-            .with_columns([
-                (pl.col("sigma_mrpl") - pl.col("base_mrpl")).alias(f"LD_sigma_MRPL_2012_{h}"),
-                (pl.col("sigma_mrpk") - pl.col("base_mrpk")).alias(f"LD_sigma_MRPK_2012_{h}"),
-                (pl.col("sigma_markup") - pl.col("base_markup")).alias(f"LD_sigma_markup_2012_{h}"),
-            ])
-            .select([
-                COUNTRY_COL, INDUSTRY_COL,
-                f"LD_sigma_MRPL_2012_{h}",
-                f"LD_sigma_MRPK_2012_{h}",
-                f"LD_sigma_markup_2012_{h}",
-            ])
-        )
-        results.append(ld)
-
-    if not results:
-        return pl.DataFrame()
-
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
+    return to_output(out)
 
-    out = out.rename({
-        COUNTRY_COL: "fic_code",
-        INDUSTRY_COL: "borrower_sic",
-    })
-    return out
 
-
-def compute_dispersion_block2(df: pl.LazyFrame) -> pl.DataFrame:
+def compute_dispersion_block2(df: pl.LazyFrame) -> pl.LazyFrame:
     """
     Compute long-difference dispersion from PRESHOCK_BASE.
 
@@ -116,46 +95,14 @@ def compute_dispersion_block2(df: pl.LazyFrame) -> pl.DataFrame:
       LD_sigma_MRPL_2010_2013, ..., LD_sigma_MRPK_2010_2013, ...,
       LD_sigma_markup_2010_2013, ...
     """
-    disp = _compute_dispersion_by_year(df).collect()
-
-    base = (
-        disp.filter(pl.col(YEAR_COL) == PRESHOCK_BASE)
-        .select([
-            COUNTRY_COL, INDUSTRY_COL,
-            pl.col("sigma_mrpl").alias("base_mrpl"),
-            pl.col("sigma_mrpk").alias("base_mrpk"),
-            pl.col("sigma_markup").alias("base_markup"),
-        ])
+    out = long_difference(
+        _compute_dispersion_by_year(df),
+        {
+            "sigma_mrpl": "sigma_MRPL",
+            "sigma_mrpk": "sigma_MRPK",
+            "sigma_markup": "sigma_markup",
+        },
+        PRESHOCK_BASE, BLOCK2_HORIZONS,
     )
 
-    results = []
-    for h in BLOCK2_HORIZONS:
-        horizon = disp.filter(pl.col(YEAR_COL) == h)
-        ld = (
-            base.join(horizon, on=[COUNTRY_COL, INDUSTRY_COL], how="inner")
-            .with_columns([
-                (pl.col("sigma_mrpl") - pl.col("base_mrpl")).alias(f"LD_sigma_MRPL_{PRESHOCK_BASE}_{h}"),
-                (pl.col("sigma_mrpk") - pl.col("base_mrpk")).alias(f"LD_sigma_MRPK_{PRESHOCK_BASE}_{h}"),
-                (pl.col("sigma_markup") - pl.col("base_markup")).alias(f"LD_sigma_markup_{PRESHOCK_BASE}_{h}"),
-            ])
-            .select([
-                COUNTRY_COL, INDUSTRY_COL,
-                f"LD_sigma_MRPL_{PRESHOCK_BASE}_{h}",
-                f"LD_sigma_MRPK_{PRESHOCK_BASE}_{h}",
-                f"LD_sigma_markup_{PRESHOCK_BASE}_{h}",
-            ])
-        )
-        results.append(ld)
-
-    if not results:
-        return pl.DataFrame()
-
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
-
-    out = out.rename({
-        COUNTRY_COL: "fic_code",
-        INDUSTRY_COL: "borrower_sic",
-    })
-    return out
+    return to_output(out)
@@ -18,46 +18,39 @@ from config import (
     SALES_COL, COGS_COL, TREATMENT_YEAR, HORIZONS,
     PRESHOCK_BASE, BLOCK2_HORIZONS,
 )
+from outcomes.common import positive, with_shares, pivot_horizons, to_output
 
 
 def compute_firm_markup(df: pl.LazyFrame) -> pl.LazyFrame:
     """Add firm-level markup and within-industry sales share."""
     return (
         df
-        .filter(
-            pl.col(COGS_COL).is_not_null()
-            & (pl.col(COGS_COL) > 0)
-            & pl.col(SALES_COL).is_not_null()
-            & (pl.col(SALES_COL) > 0)
-        )
+        .filter(positive(SALES_COL, COGS_COL))
         .with_columns(
             (pl.col(SALES_COL) / pl.col(COGS_COL)).alias("markup")
         )
         # Outlier trim: keep markup in [0.5, 10]
-        .filter((pl.col("markup") >= 0.5) & (pl.col("markup") <= 10))
-        # Within-industry sales share
-        .with_columns(
-            (pl.col(SALES_COL) / pl.col(SALES_COL).sum().over([COUNTRY_COL, INDUSTRY_COL, YEAR_COL]))
-            .alias("share")
-        )
+        .filter(pl.col("markup").is_between(0.5, 10, closed="both"))
+        # Within-industry sales share (over the trimmed sample)
+        .pipe(with_shares)
     )
 
 
-def _decompose_pair(df_t0: pl.DataFrame, df_t1: pl.DataFrame) -> dict:
+def _decompose(df: pl.LazyFrame, base_year: int, horizons: list) -> pl.LazyFrame:
     """
-    Decompose markup change between two cross-sections.
-    Returns dict with within, between, cross components per industry.
+    Decompose markup change from base_year to every horizon at once.
+    Returns within, between, cross components per industry and horizon.
     """
-    # Inner join: firms present in both periods
-    merged = df_t0.join(
-        df_t1,
+    base = df.filter(pl.col(YEAR_COL) == base_year)
+    horizon = df.filter(pl.col(YEAR_COL).is_in(horizons))
+
+    # Inner join: firms present in the base year and the horizon year
+    merged = base.join(
+        horizon,
         on=[FIRM_COL, COUNTRY_COL, INDUSTRY_COL],
         suffix="_1",
     )
 
-    if merged.height == 0:
-        return None
-
     # Average share and average markup across the two periods
     merged = merged.with_columns([
         ((pl.col("share") + pl.col("share_1")) / 2).alias("s_bar"),
@@ -66,10 +59,13 @@ def _decompose_pair(df_t0: pl.DataFrame, df_t1: pl.DataFrame) -> dict:
         (pl.col("share_1") - pl.col("share")).alias("d_s"),
     ])
 
-    # Aggregate by industry (country × SIC2)
+    # Aggregate by industry (country × SIC2) and horizon
     decomp = (
         merged
-        .group_by([COUNTRY_COL, INDUSTRY_COL])
+        .group_by(
+            [COUNTRY_COL, INDUSTRY_COL, pl.col(f"{YEAR_COL}_1").alias("horizon")],
+            maintain_order=False,
+        )
         .agg([
             (pl.col("s_bar") * pl.col("d_mu")).sum().alias("within"),
             (pl.col("mu_bar") * pl.col("d_s")).sum().alias("between"),
@@ -79,81 +75,36 @@ def _decompose_pair(df_t0: pl.DataFrame, df_t1: pl.DataFrame) -> dict:
     return decomp
 
 
-def compute_markup_decomposition(df: pl.LazyFrame) -> pl.DataFrame:
+def compute_markup_decomposition(df: pl.LazyFrame) -> pl.LazyFrame:
     """
     Compute long-difference De Loecker decomposition.
 
-    Returns industry-level DataFrame with columns:
+    Returns industry-level LazyFrame with columns:
       fic_code, borrower_sic,
       LD_Within_2012_2013, LD_Within_2012_2014, LD_Within_2012_2015,
       LD_Between_2012_2013, ..., LD_Cross_2012_2013, ...
     """
-    collected = df.collect()
-
-    # Base year cross-section
-    base = collected.filter(pl.col(YEAR_COL) == TREATMENT_YEAR)
-
-    results = []
-    for h in HORIZONS:
-        horizon_df = collected.filter(pl.col(YEAR_COL) == h)
-        decomp = _decompose_pair(base, horizon_df)
-        if decomp is None:
-            continue
-        decomp = decomp.rename({
-            "within":  f"LD_Within_2012_{h}",
-            "between": f"LD_Between_2012_{h}",
-            "cross":   f"LD_Cross_2012_{h}",
-        })
-        results.append(decomp)
-
-    if not results:
-        return pl.DataFrame()
-
-    # Join all horizons
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
+    out = pivot_horizons(
+        _decompose(df, TREATMENT_YEAR, HORIZONS),
+        {"within": "Within", "between": "Between", "cross": "Cross"},
+        TREATMENT_YEAR, HORIZONS,
+    )
 
     # Rename to match IV pipeline convention
-    out = out.rename({
-        COUNTRY_COL: "fic_code",
-        INDUSTRY_COL: "borrower_sic",
-    })
-    return out
+    return to_output(out)
 
 
-def compute_markup_decomposition_block2(df: pl.LazyFrame) -> pl.DataFrame:
+def compute_markup_decomposition_block2(df: pl.LazyFrame) -> pl.LazyFrame:
     """
     Compute De Loecker decomposition from PRESHOCK_BASE to BLOCK2_HORIZONS.
 
     Returns columns: fic_code, borrower_sic,
       LD_Within_2010_2013, LD_Between_2010_2013, LD_Cross_2010_2013, ...
     """
-    collected = df.collect()
-    base = collected.filter(pl.col(YEAR_COL) == PRESHOCK_BASE)
-
-    results = []
-    for h in BLOCK2_HORIZONS:
-        horizon_df = collected.filter(pl.col(YEAR_COL) == h)
-        decomp = _decompose_pair(base, horizon_df)
-        if decomp is None:
-            continue
-        decomp = decomp.rename({
-            "within":  f"LD_Within_{PRESHOCK_BASE}_{h}",
-            "between": f"LD_Between_{PRESHOCK_BASE}_{h}",
-            "cross":   f"LD_Cross_{PRESHOCK_BASE}_{h}",
-        })
-        results.append(decomp)
-
-    if not results:
-        return pl.DataFrame()
-
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
-
-    out = out.rename({
-        COUNTRY_COL: "fic_code",
-        INDUSTRY_COL: "borrower_sic",
-    })
-    return out
+    out = pivot_horizons(
+        _decompose(df, PRESHOCK_BASE, BLOCK2_HORIZONS),
+        {"within": "Within", "between": "Between", "cross": "Cross"},
+        PRESHOCK_BASE, BLOCK2_HORIZONS,
+    )
+
+    return to_output(out)
@@ -12,120 +12,67 @@ Long-difference: LD_OPcov_2012_20YY = OPcov_{j,20YY} − OPcov_{j,2012}
 
 import polars as pl
 from config import (
-    FIRM_COL, YEAR_COL, COUNTRY_COL, INDUSTRY_COL,
+    YEAR_COL, COUNTRY_COL, INDUSTRY_COL,
     SALES_COL, EMPLOYEES_COL, TREATMENT_YEAR, HORIZONS,
     PRESHOCK_BASE, BLOCK2_HORIZONS,
 )
+from outcomes.common import with_shares, long_difference, to_output
 
 
 def _compute_opcov_by_year(df: pl.LazyFrame) -> pl.LazyFrame:
-    """Compute OP covariance per industry-year."""
+    """Compute OP covariance per industry-year.
+
+    Uses Σ_i (s_i − s̄)(φ_i − φ̄) = Σ_i s_i φ_i − (Σ_i s_i)(Σ_i φ_i) / n,
+    so a single group_by replaces the demeaning windows.
+    """
+    # Shares are renormalised over the firms that report employment
     return (
-        df
-        .filter(
-            pl.col(EMPLOYEES_COL).is_not_null()
-            & (pl.col(EMPLOYEES_COL) > 0)
-            & pl.col(SALES_COL).is_not_null()
-            & (pl.col(SALES_COL) > 0)
+        with_shares(df.filter(pl.col(EMPLOYEES_COL) > 0))
+        .with_columns(
+            (pl.col(SALES_COL) / pl.col(EMPLOYEES_COL)).log().alias("labor_prod")
         )
-        .with_columns([
-            (pl.col(SALES_COL) / pl.col(SALES_COL).sum().over([COUNTRY_COL, INDUSTRY_COL, YEAR_COL]))
-            .alias("share"),
-            (pl.col(SALES_COL) / pl.col(EMPLOYEES_COL)).log().alias("labor_prod"),
+        .group_by([COUNTRY_COL, INDUSTRY_COL, YEAR_COL], maintain_order=False)
+        .agg([
+            (pl.col("share") * pl.col("labor_prod")).sum().alias("s_phi"),
+            pl.col("share").sum().alias("s_sum"),
+            pl.col("labor_prod").sum().alias("phi_sum"),
+            pl.len().alias("n"),
         ])
-        # Demeaned share and productivity within industry-year
-        .with_columns([
-            (pl.col("share") - pl.col("share").mean().over([COUNTRY_COL, INDUSTRY_COL, YEAR_COL]))
-            .alias("d_share"),
-            (pl.col("labor_prod") - pl.col("labor_prod").mean().over([COUNTRY_COL, INDUSTRY_COL, YEAR_COL]))
-            .alias("d_prod"),
+        .select([
+            COUNTRY_COL, INDUSTRY_COL, YEAR_COL,
+            (pl.col("s_phi") - pl.col("s_sum") * pl.col("phi_sum") / pl.col("n")).alias("opcov"),
         ])
-        .with_columns(
-            (pl.col("d_share") * pl.col("d_prod")).alias("cov_term")
-        )
-        .group_by([COUNTRY_COL, INDUSTRY_COL, YEAR_COL])
-        .agg(
-            pl.col("cov_term").sum().alias("opcov")
-        )
     )
 
 
-def compute_op_covariance(df: pl.LazyFrame) -> pl.DataFrame:
+def compute_op_covariance(df: pl.LazyFrame) -> pl.LazyFrame:
     """
     Compute long-difference OP covariance.
 
-    Returns industry-level DataFrame with columns:
+    Returns industry-level LazyFrame with columns:
       fic_code, borrower_sic,
       LD_OPcov_2012_2013, LD_OPcov_2012_2014, LD_OPcov_2012_2015
     """
-    opcov = _compute_opcov_by_year(df).collect()
-
-    base = opcov.filter(pl.col(YEAR_COL) == TREATMENT_YEAR).select([
-        COUNTRY_COL, INDUSTRY_COL,
-        pl.col("opcov").alias("opcov_base"),
-    ])
-
-    results = []
-    for h in HORIZONS:
-        horizon = opcov.filter(pl.col(YEAR_COL) == h)
-        ld = (
-            base.join(horizon, on=[COUNTRY_COL, INDUSTRY_COL], how="inner")
-            .with_columns(
-                (pl.col("opcov") - pl.col("opcov_base")).alias(f"LD_OPcov_2012_{h}")
-            )
-            .select([COUNTRY_COL, INDUSTRY_COL, f"LD_OPcov_2012_{h}"])
-        )
-        results.append(ld)
-
-    if not results:
-        return pl.DataFrame()
-
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
+    out = long_difference(
+        _compute_opcov_by_year(df),
+        {"opcov": "OPcov"},
+        TREATMENT_YEAR, HORIZONS,
+    )
 
-    out = out.rename({
-        COUNTRY_COL: "fic_code",
-        INDUSTRY_COL: "borrower_sic",
-    })
-    return out
+    return to_output(out)
 
 
-def compute_op_covariance_block2(df: pl.LazyFrame) -> pl.DataFrame:
+def compute_op_covariance_block2(df: pl.LazyFrame) -> pl.LazyFrame:
     """
     Compute long-difference OP covariance from PRESHOCK_BASE.
 
     Returns columns: fic_code, borrower_sic,
       LD_OPcov_2010_2013, LD_OPcov_2010_2014
     """
-    opcov = _compute_opcov_by_year(df).collect()
-
-    base = opcov.filter(pl.col(YEAR_COL) == PRESHOCK_BASE).select([
-        COUNTRY_COL, INDUSTRY_COL,
-        pl.col("opcov").alias("opcov_base"),
-    ])
-
-    results = []
-    for h in BLOCK2_HORIZONS:
-        horizon = opcov.filter(pl.col(YEAR_COL) == h)
-        ld = (
-            base.join(horizon, on=[COUNTRY_COL, INDUSTRY_COL], how="inner")
-            .with_columns(
-                (pl.col("opcov") - pl.col("opcov_base")).alias(f"LD_OPcov_{PRESHOCK_BASE}_{h}")
-            )
-            .select([COUNTRY_COL, INDUSTRY_COL, f"LD_OPcov_{PRESHOCK_BASE}_{h}"])
-        )
-        results.append(ld)
-
-    if not results:
-        return pl.DataFrame()
-
-    out = results[0]
-    for r in results[1:]:
-        out = out.join(r, on=[COUNTRY_COL, INDUSTRY_COL], how="left")
+    out = long_difference(
+        _compute_opcov_by_year(df),
+        {"opcov": "OPcov"},
+        PRESHOCK_BASE, BLOCK2_HORIZONS,
+    )
 
-    out = out.rename({
-        COUNTRY_COL: "fic_code",
-        INDUSTRY_COL: "borrower_sic",
-    })
-    return out
+    return to_output(out)
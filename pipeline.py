@@ -1,5 +1,5 @@
 """
-Orchestrator: load cleaned Orbis parquets → compute outcome variables → save CSVs.
+Orchestrator: load cleaned Orbis parquets → compute outcome variables → save parquet/CSV tables.
 
 Usage on Colab:
     from pipeline import run_all
@@ -9,115 +9,240 @@ Usage on Colab:
 
 import os
 import glob
+from concurrent.futures import ThreadPoolExecutor
+import shutil
 import polars as pl
+import pyarrow.dataset as ds
 from config import (
-    MASTER_DIR, OUTPUT_DIR, FIRM_COL, YEAR_COL,
+    MASTER_DIR, OUTPUT_DIR, PANEL_DIR, FIRM_COL, YEAR_COL, YEARS,
     COUNTRY_COL, INDUSTRY_COL, SALES_COL,
+    COGS_COL, EMPLOYEES_COL, ASSETS_COL,
 )
+from outcomes.common import with_shares
 from outcomes.markup import compute_firm_markup, compute_markup_decomposition, compute_markup_decomposition_block2
 from outcomes.op_covariance import compute_op_covariance, compute_op_covariance_block2
 from outcomes.dispersion import compute_dispersion, compute_dispersion_block2
 from outcomes.concentration import compute_concentration, compute_concentration_block2
 
+# Only these columns are read from the parquets (projection pushdown)
+KEEP_COLS = [
+    FIRM_COL, INDUSTRY_COL, YEAR_COL,
+    SALES_COL, COGS_COL, EMPLOYEES_COL, ASSETS_COL,
+]
 
-def load_data(test: bool = False) -> pl.LazyFrame:
-    """Load parquets from MASTER_DIR, derive country and SIC2.
 
-    If test=True, loads only the first parquet file (smoke test).
-    """
+def _master_files() -> list:
+    """Sorted list of master parquet paths in MASTER_DIR."""
     pattern = os.path.join(MASTER_DIR, "*.parquet")
     files = sorted(glob.glob(pattern))
     if not files:
         raise FileNotFoundError(f"No parquet files found in {MASTER_DIR}/")
+    return files
+
+
+def _master_manifest(files: list) -> str:
+    """Scan settings plus one "name<TAB>size<TAB>mtime_ns" line per master file.
+
+    YEARS and KEEP_COLS are included because they shape the cached panel.
+    No data is read.
+    """
+    lines = [
+        f"years\t{min(YEARS)}-{max(YEARS)}",
+        "columns\t" + ",".join(KEEP_COLS),
+    ]
+    for f in files:
+        st = os.stat(f)
+        lines.append(f"{os.path.basename(f)}\t{st.st_size}\t{st.st_mtime_ns}")
+    return "\n".join(lines) + "\n"
+
+
+def _scan_master(test: bool = False) -> pl.LazyFrame:
+    """Scan parquets from MASTER_DIR, derive country and SIC2.
+
+    Only KEEP_COLS and firm-years within YEARS are scanned.
+    If test=True, scans only the first parquet file (smoke test).
+    """
+    files = _master_files()
 
     if test:
         files = files[:1]
         print(f"SMOKE TEST: loading only {os.path.basename(files[0])}")
 
     print(f"Loading {len(files)} parquet file(s) from {MASTER_DIR}/ ...")
-    df = pl.scan_parquet(files)
-
-    # Derive country from bvd_id[:2]
-    df = df.with_columns(
-        pl.col(FIRM_COL).str.slice(0, 2).alias(COUNTRY_COL)
+    # Arrow's dataset scanner opens and decodes files concurrently, which
+    # hides per-file latency on the Drive mount
+    dset = ds.dataset(files, format="parquet")
+    # Row count from parquet footers only; no column data is read
+    print(f"  Found {dset.count_rows():,} firm-year observations")
+
+    # Projection and the year filter are pushed into the Arrow scanner
+    df = (
+        pl.scan_pyarrow_dataset(dset)
+        .select(KEEP_COLS)
+        .filter(pl.col(YEAR_COL).is_between(min(YEARS), max(YEARS)))
     )
 
-    # Truncate SIC to 2-digit (string)
-    df = df.with_columns(
-        pl.col(INDUSTRY_COL).cast(pl.Utf8).str.slice(0, 2).alias(INDUSTRY_COL)
-    )
+    # One projection: country from bvd_id[:2], SIC truncated to 2 digits.
+    # Low-cardinality keys are categorical so group_by/join hash ids, not strings
+    df = df.with_columns([
+        pl.col(FIRM_COL).str.slice(0, 2).cast(pl.Categorical).alias(COUNTRY_COL),
+        pl.col(INDUSTRY_COL).cast(pl.Utf8).str.slice(0, 2).cast(pl.Categorical).alias(INDUSTRY_COL),
+        pl.col(YEAR_COL).cast(pl.Int16),
+    ])
 
-    n = df.select(pl.count()).collect().item()
-    print(f"  Loaded {n:,} firm-year observations")
     return df
 
 
+def prepare_cache() -> str:
+    """Write the derived firm-year panel to PANEL_DIR, partitioned by year.
+
+    country stays a regular column: it is the raw bvd_id prefix and may
+    contain characters (e.g. "*") that do not survive a hive path.
+
+    PANEL_DIR/_SUCCESS records the scan settings and the master file list
+    with sizes and mtimes. The cache is reused only while these match; a
+    change to YEARS or KEEP_COLS, or any added, removed or rewritten master
+    file triggers a rebuild.
+    """
+    marker = os.path.join(PANEL_DIR, "_SUCCESS")
+    manifest = _master_manifest(_master_files())
+    if os.path.exists(marker):
+        with open(marker) as fh:
+            if fh.read() == manifest:
+                return PANEL_DIR
+        print(f"Master parquets or settings changed since {PANEL_DIR}/ was built; rebuilding ...")
+
+    # Drop a stale cache or leftovers of an interrupted run before writing
+    shutil.rmtree(PANEL_DIR, ignore_errors=True)
+    print(f"Caching firm-year panel to {PANEL_DIR}/ ...")
+    _scan_master().sink_parquet(
+        pl.PartitionBy(PANEL_DIR, key=[YEAR_COL]),
+        compression="zstd",
+        mkdir=True,
+    )
+    with open(marker, "w") as fh:
+        fh.write(manifest)
+    return PANEL_DIR
+
+
+def load_data(test: bool = False, use_cache: bool = False) -> pl.LazyFrame:
+    """Load the firm-year panel with country, SIC2 and sales share.
+
+    With use_cache=True, reads the partitioned cache in PANEL_DIR (built or
+    refreshed by prepare_cache). Otherwise scans the master parquets
+    directly and leaves the cache untouched. If test=True, scans only the
+    first master parquet.
+    """
+    if test or not use_cache:
+        df = _scan_master(test=test)
+    else:
+        prepare_cache()
+        print(f"Loading cached panel from {PANEL_DIR}/ ...")
+        df = pl.scan_parquet(
+            os.path.join(PANEL_DIR, "**", "*.parquet"),
+            hive_partitioning=True,
+            hive_schema={YEAR_COL: pl.Int16},
+        )
+
+    # Positive-sales firm-years with within-industry sales share, shared by all modules
+    return with_shares(df)
+
+
+def _write_table(out: pl.DataFrame, stem: str) -> None:
+    """Write one industry-level table as {stem}.parquet and {stem}.csv."""
+    # Parquet (zstd) for fast re-reads; CSV kept for the local notebook/R workflow
+    out.write_parquet(f"{stem}.parquet", compression="zstd", statistics=True)
+    out.write_csv(f"{stem}.csv", batch_size=64_000)
+
+
+def _collect_and_save(
+    plans: dict,
+    out_names: dict,
+    out_dir: str,
+    save: bool,
+    label: str = "",
+    sinks: list | None = None,
+) -> dict:
+    """Collect all plans (and any lazy sinks) in one streaming batch, then save.
+
+    Returns dict of outcome name → DataFrame, in the order of plans.
+    """
+    collected = pl.collect_all([*plans.values(), *(sinks or [])], engine="streaming")
+    results = dict(zip(plans, collected))
+
+    for i, (name, out) in enumerate(results.items(), start=1):
+        print(f"\n[{label}{i}/{len(results)}] {name}: {out.height} industry-pairs")
+
+    if save:
+        stems = [os.path.join(out_dir, out_names[name]) for name in results]
+        # Polars writers release the GIL, so the tables are written concurrently
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(_write_table, results.values(), stems))
+        for stem in stems:
+            print(f"  Saved: {stem}.parquet / .csv")
+
+    return results
+
+
 def run_all(save: bool = True, test: bool = False) -> dict:
     """
     Run all outcome modules and save results.
 
+    The four modules are built as lazy plans over the same scan and
+    collected together on the streaming engine. Industry-year sales totals
+    and CR4 top-4 lists are computed in earlier streaming passes and joined
+    back as small tables, so the firm-year panel is never fully held in
+    memory; only the base-year cross-sections of the turbulence and markup
+    self-joins are.
+
     Args:
         save: Write output CSVs/parquets to OUTPUT_DIR.
         test: If True, load only one parquet file (smoke test).
 
     Returns dict of outcome name → DataFrame for inspection.
     """
-    df = load_data(test=test)
+    # Only runs that save write (and read) the panel cache on Drive
+    df = load_data(test=test, use_cache=save)
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    results = {}
 
-    # 1. Markup decomposition
-    print("\n[1/4] Computing markup decomposition ...")
     df_markup = compute_firm_markup(df)
-    markup_decomp = compute_markup_decomposition(df_markup)
-    results["markup_decomp"] = markup_decomp
-    print(f"  → {markup_decomp.height} industry-pairs")
-
+    plans = {
+        "markup_decomp": compute_markup_decomposition(df_markup),
+        "op_covariance": compute_op_covariance(df),
+        "dispersion": compute_dispersion(df),
+        "concentration": compute_concentration(df),
+    }
+    out_names = {
+        "markup_decomp": "industry_markup_decomp",
+        "op_covariance": "industry_op_covariance",
+        "dispersion": "industry_dispersion",
+        "concentration": "industry_concentration",
+    }
+
+    sinks = []
     if save:
-        # Save firm-level markup panel as parquet (large)
-        firm_markup = df_markup.collect()
+        # Firm-level markup panel (large) is streamed straight to disk
+        # in the same batch, so it shares the scan with the outcomes.
+        # Keys go back to plain String/Int64 so the file schema is unchanged.
         firm_path = os.path.join(OUTPUT_DIR, "firm_panel_markup.parquet")
-        firm_markup.write_parquet(firm_path)
-        print(f"  Saved firm panel: {firm_path}")
-
-        # Save industry decomposition as CSV
-        csv_path = os.path.join(OUTPUT_DIR, "industry_markup_decomp.csv")
-        markup_decomp.write_csv(csv_path)
-        print(f"  Saved decomposition: {csv_path}")
-
-    # 2. OP covariance
-    print("\n[2/4] Computing OP covariance ...")
-    opcov = compute_op_covariance(df)
-    results["op_covariance"] = opcov
-    print(f"  → {opcov.height} industry-pairs")
-
-    if save:
-        csv_path = os.path.join(OUTPUT_DIR, "industry_op_covariance.csv")
-        opcov.write_csv(csv_path)
-        print(f"  Saved: {csv_path}")
-
-    # 3. Dispersion
-    print("\n[3/4] Computing MRPK/MRPL/markup dispersion ...")
-    disp = compute_dispersion(df)
-    results["dispersion"] = disp
-    print(f"  → {disp.height} industry-pairs")
-
-    if save:
-        csv_path = os.path.join(OUTPUT_DIR, "industry_dispersion.csv")
-        disp.write_csv(csv_path)
-        print(f"  Saved: {csv_path}")
-
-    # 4. Concentration & turbulence
-    print("\n[4/4] Computing CR4, n_firms, turbulence ...")
-    conc = compute_concentration(df)
-    results["concentration"] = conc
-    print(f"  → {conc.height} industry-pairs")
-
+        sinks.append(
+            df_markup
+            .with_columns([
+                pl.col(COUNTRY_COL).cast(pl.Utf8),
+                pl.col(INDUSTRY_COL).cast(pl.Utf8),
+                pl.col(YEAR_COL).cast(pl.Int64),
+            ])
+            .sink_parquet(
+                firm_path, compression="zstd", row_group_size=200_000, lazy=True,
+            )
+        )
+
+    print("\nComputing markup decomposition, OP covariance, "
+          "MRPK/MRPL/markup dispersion, CR4/n_firms/turbulence ...")
+    results = _collect_and_save(plans, out_names, OUTPUT_DIR, save, sinks=sinks)
     if save:
-        csv_path = os.path.join(OUTPUT_DIR, "industry_concentration.csv")
-        conc.write_csv(csv_path)
-        print(f"  Saved: {csv_path}")
+        print(f"\n  Saved firm panel: {firm_path}")
 
     print(f"\nDone. All outputs saved to {OUTPUT_DIR}/")
     return results
@@ -132,56 +257,27 @@ def run_block2_mediators(save: bool = True, test: bool = False) -> dict:
 
     Saves to {OUTPUT_DIR}/block2/ subfolder.
     """
-    df = load_data(test=test)
+    # Only runs that save write (and read) the panel cache on Drive
+    df = load_data(test=test, use_cache=save)
 
     block2_dir = os.path.join(OUTPUT_DIR, "block2")
     os.makedirs(block2_dir, exist_ok=True)
-    results = {}
 
-    # 1. Markup decomposition (needs firm-level markup first)
-    print("\n[Block2 1/4] Computing markup decomposition (2010 base) ...")
-    df_markup = compute_firm_markup(df)
-    markup_b2 = compute_markup_decomposition_block2(df_markup)
-    results["markup_decomp"] = markup_b2
-    print(f"  → {markup_b2.height} industry-pairs")
-
-    if save:
-        csv_path = os.path.join(block2_dir, "industry_markup_decomp_2010base.csv")
-        markup_b2.write_csv(csv_path)
-        print(f"  Saved: {csv_path}")
-
-    # 2. OP covariance
-    print("\n[Block2 2/4] Computing OP covariance (2010 base) ...")
-    opcov_b2 = compute_op_covariance_block2(df)
-    results["op_covariance"] = opcov_b2
-    print(f"  → {opcov_b2.height} industry-pairs")
-
-    if save:
-        csv_path = os.path.join(block2_dir, "industry_op_covariance_2010base.csv")
-        opcov_b2.write_csv(csv_path)
-        print(f"  Saved: {csv_path}")
-
-    # 3. Dispersion
-    print("\n[Block2 3/4] Computing dispersion (2010 base) ...")
-    disp_b2 = compute_dispersion_block2(df)
-    results["dispersion"] = disp_b2
-    print(f"  → {disp_b2.height} industry-pairs")
-
-    if save:
-        csv_path = os.path.join(block2_dir, "industry_dispersion_2010base.csv")
-        disp_b2.write_csv(csv_path)
-        print(f"  Saved: {csv_path}")
-
-    # 4. Concentration & turbulence
-    print("\n[Block2 4/4] Computing CR4, n_firms, turbulence (2010 base) ...")
-    conc_b2 = compute_concentration_block2(df)
-    results["concentration"] = conc_b2
-    print(f"  → {conc_b2.height} industry-pairs")
-
-    if save:
-        csv_path = os.path.join(block2_dir, "industry_concentration_2010base.csv")
-        conc_b2.write_csv(csv_path)
-        print(f"  Saved: {csv_path}")
+    plans = {
+        "markup_decomp": compute_markup_decomposition_block2(compute_firm_markup(df)),
+        "op_covariance": compute_op_covariance_block2(df),
+        "dispersion": compute_dispersion_block2(df),
+        "concentration": compute_concentration_block2(df),
+    }
+    out_names = {
+        "markup_decomp": "industry_markup_decomp_2010base",
+        "op_covariance": "industry_op_covariance_2010base",
+        "dispersion": "industry_dispersion_2010base",
+        "concentration": "industry_concentration_2010base",
+    }
+
+    print("\n[Block2] Computing all outcome modules (2010 base) ...")
+    results = _collect_and_save(plans, out_names, block2_dir, save, label="Block2 ")
 
     print(f"\nBlock 2 mediators done. Saved to {block2_dir}/")
     return results